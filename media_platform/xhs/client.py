@@ -1,13 +1,16 @@
 import asyncio
-import json
 import httpx
+import ijson
+import orjson
 import aiofiles
+import aiofiles.os
 from datetime import datetime
-import os
-from typing import Callable, Dict, List, Optional
-from urllib.parse import urlencode
+from typing import Any, AsyncIterator, Callable, Dict, List, NoReturn, Optional
+from urllib.parse import quote_plus, urlencode
 from enum import Enum
 from playwright.async_api import BrowserContext, Page
+from tenacity import (AsyncRetrying, retry_if_exception_type, stop_after_attempt,
+                      wait_exponential, wait_random)
 
 from tools import utils
 
@@ -16,6 +19,29 @@ from .field import SearchNoteType, SearchSortType
 from .help import get_search_id, sign
 
 
+class AsyncBytesReader:
+    """把异步字节迭代器包装成 ijson 需要的带 read 方法的异步文件对象"""
+
+    def __init__(self, byte_iterator: AsyncIterator[bytes]):
+        self._byte_iterator = byte_iterator
+
+    async def read(self, size: int = -1) -> bytes:
+        # ijson 会先调用 read(0) 判断返回的是 bytes 还是 str，此时不能消费数据
+        if size == 0:
+            return b""
+        try:
+            return await self._byte_iterator.__anext__()
+        except StopAsyncIteration:
+            return b""
+
+
+async def read_file_chunks(file_path: str, chunk_size: int = 1 << 20) -> AsyncIterator[bytes]:
+    """按固定大小分块读取文件，用于流式上传，内存占用只有一个分块大小"""
+    async with aiofiles.open(file_path, "rb") as f:
+        while chunk := await f.read(chunk_size):
+            yield chunk
+
+
 class NoteType(Enum):
     NORMAL = "normal"
     VIDEO = "video"
@@ -41,6 +67,23 @@ class XHSClient:
         self.NOTE_ABNORMAL_CODE = -510001
         self.playwright_page = playwright_page
         self.cookie_dict = cookie_dict
+        # localStorage 中的 b1 很少变化，缓存下来避免每次签名都读取
+        self._b1: Optional[str] = None
+        # 复用同一个连接池，避免每次请求都重新建立 TCP/TLS 连接；开启 HTTP/2 让并发请求复用同一条连接
+        self._client = httpx.AsyncClient(
+            proxies=self.proxies,
+            timeout=self.timeout,
+            http2=True,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60),
+        )
+
+    async def aclose(self):
+        """
+        关闭底层的 httpx 连接池，爬虫结束时调用
+        Returns:
+
+        """
+        await self._client.aclose()
 
     async def _pre_headers(self, url: str, data=None) -> Dict:
         """
@@ -52,23 +95,61 @@ class XHSClient:
         Returns:
 
         """
-        encrypt_params = await self.playwright_page.evaluate("([url, data]) => window._webmsxyw(url,data)", [url, data])
-        local_storage = await self.playwright_page.evaluate("() => window.localStorage")
+        if self._b1 is None:
+            # 签名和 localStorage.b1 合并成一次 evaluate，减少一次浏览器 IPC
+            encrypt_params, b1 = await self.playwright_page.evaluate(
+                "([url, data]) => [window._webmsxyw(url,data), window.localStorage.getItem('b1')]", [url, data])
+            self._b1 = b1 or ""
+        else:
+            encrypt_params = await self.playwright_page.evaluate(
+                "([url, data]) => window._webmsxyw(url,data)", [url, data])
         signs = sign(
             a1=self.cookie_dict.get("a1", ""),
-            b1=local_storage.get("b1", ""),
+            b1=self._b1,
             x_s=encrypt_params.get("X-s", ""),
             x_t=str(encrypt_params.get("X-t", ""))
         )
 
-        headers = {
+        # 每个请求返回独立的请求头，避免并发请求互相覆盖共享的 self.headers
+        return {
+            **self.headers,
             "X-S": signs["x-s"],
             "X-T": signs["x-t"],
             "x-S-Common": signs["x-s-common"],
             "X-B3-Traceid": signs["x-b3-traceid"]
         }
-        self.headers.update(headers)
-        return self.headers
+
+    @staticmethod
+    def _retrying(retry_on_error: bool) -> AsyncRetrying:
+        """
+        网络异常或者 IP 被限制时按指数退避重试，每次重试都会重新签名
+        Args:
+            retry_on_error: 是否失败重试，为 False 时只请求一次
+
+        Returns:
+
+        """
+        return AsyncRetrying(
+            stop=stop_after_attempt(3 if retry_on_error else 1),
+            wait=wait_exponential(max=30) + wait_random(0, 1),
+            retry=retry_if_exception_type((httpx.TransportError, IPBlockError)),
+            reraise=True,
+        )
+
+    def _raise_data_error(self, data: Dict) -> NoReturn:
+        """
+        根据接口返回的失败数据抛出对应的异常
+        Args:
+            data: 接口返回的 success 为 False 的数据
+
+        Returns:
+
+        """
+        if data.get("code") == self.IP_ERROR_CODE:
+            raise IPBlockError(self.IP_ERROR_STR)
+        # 可能是签名失效，下次签名时重新读取 b1
+        self._b1 = None
+        raise DataFetchError(data.get("msg") or "")
 
     async def request(self, method, url, **kwargs) -> Dict:
         """
@@ -81,31 +162,25 @@ class XHSClient:
         Returns:
 
         """
-        async with httpx.AsyncClient(proxies=self.proxies) as client:
-            response = await client.request(
-                method, url, timeout=self.timeout,
-                **kwargs
-            )
-        if not len(response.text):
+        response = await self._client.request(method, url, **kwargs)
+        if not len(response.content):
             return response
         try:
-            data = response.json()
-        except json.decoder.JSONDecodeError:
+            data = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
             return response
         # data: Dict = response.json()
         if data["success"]:
             return data.get("data", data.get("success", {}))
-        elif data["code"] == self.IP_ERROR_CODE:
-            raise IPBlockError(self.IP_ERROR_STR)
-        else:
-            raise DataFetchError(data.get("msg", None))
+        self._raise_data_error(data)
 
-    async def get(self, uri: str, params=None) -> Dict:
+    async def get(self, uri: str, params=None, retry_on_error: bool = True) -> Dict:
         """
         GET请求，对请求头签名
         Args:
             uri: 请求路由
             params: 请求参数
+            retry_on_error: 是否失败重试，GET 请求默认重试
 
         Returns:
 
@@ -114,23 +189,30 @@ class XHSClient:
         if isinstance(params, dict):
             final_uri = (f"{uri}?"
                          f"{urlencode(params)}")
-        headers = await self._pre_headers(final_uri)
-        return await self.request(method="GET", url=f"{self._host}{final_uri}", headers=headers)
+        async for attempt in self._retrying(retry_on_error):
+            with attempt:
+                headers = await self._pre_headers(final_uri)
+                return await self.request(method="GET", url=f"{self._host}{final_uri}", headers=headers)
+        raise AssertionError("unreachable")
 
-    async def post(self, uri: str, data: dict) -> Dict:
+    async def post(self, uri: str, data: dict, retry_on_error: bool = False) -> Dict:
         """
         POST请求，对请求头签名
         Args:
             uri: 请求路由
             data: 请求体参数
+            retry_on_error: 是否失败重试，POST 请求可能不是幂等的，默认不重试
 
         Returns:
 
         """
-        headers = await self._pre_headers(uri, data)
-        json_str = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
-        return await self.request(method="POST", url=f"{self._host}{uri}",
-                                  data=json_str, headers=headers)
+        json_bytes = orjson.dumps(data)
+        async for attempt in self._retrying(retry_on_error):
+            with attempt:
+                headers = await self._pre_headers(uri, data)
+                return await self.request(method="POST", url=f"{self._host}{uri}",
+                                          content=json_bytes, headers=headers)
+        raise AssertionError("unreachable")
 
     async def pong(self) -> bool:
         """
@@ -146,7 +228,7 @@ class XHSClient:
             if note_card.get("items"):
                 ping_flag = True
         except Exception as e:
-            utils.logger.error(f"[XHSClient.pong] Ping xhs failed: {e}, and try to login again...")
+            utils.logger.error("[XHSClient.pong] Ping xhs failed: %s, and try to login again...", e)
             ping_flag = False
         return ping_flag
 
@@ -162,6 +244,16 @@ class XHSClient:
         cookie_str, cookie_dict = utils.convert_cookies(await browser_context.cookies())
         self.headers["Cookie"] = cookie_str
         self.cookie_dict = cookie_dict
+        await self.refresh_b1()
+
+    async def refresh_b1(self):
+        """
+        重新从浏览器 localStorage 读取签名需要的 b1 并缓存，登录态变化后调用
+        Returns:
+
+        """
+        b1 = await self.playwright_page.evaluate("() => window.localStorage.getItem('b1')")
+        self._b1 = b1 or ""
 
     async def get_self_info(self):
         uri = "/api/sns/web/v1/user/selfinfo"
@@ -171,7 +263,8 @@ class XHSClient:
             self, keyword: str,
             page: int = 1, page_size: int = 20,
             sort: SearchSortType = SearchSortType.GENERAL,
-            note_type: SearchNoteType = SearchNoteType.ALL
+            note_type: SearchNoteType = SearchNoteType.ALL,
+            search_id: str = ""
     ) -> Dict:
         """
         根据关键词搜索笔记
@@ -181,6 +274,7 @@ class XHSClient:
             page_size: 分页数据长度
             sort: 搜索结果排序指定
             note_type: 搜索的笔记类型
+            search_id: 搜索ID，同一个关键词翻页时应传入相同的值，为空时自动生成
 
         Returns:
 
@@ -190,11 +284,11 @@ class XHSClient:
             "keyword": keyword,
             "page": page,
             "page_size": page_size,
-            "search_id": get_search_id(),
+            "search_id": search_id or get_search_id(),
             "sort": sort.value,
             "note_type": note_type.value
         }
-        return await self.post(uri, data)
+        return await self.post(uri, data, retry_on_error=True)
 
     async def get_note_by_id(self, note_id: str) -> Dict:
         """
@@ -207,11 +301,11 @@ class XHSClient:
         """
         data = {"source_note_id": note_id}
         uri = "/api/sns/web/v1/feed"
-        res = await self.post(uri, data)
+        res = await self.post(uri, data, retry_on_error=True)
         if res and res.get("items"):
             res_dict: Dict = res["items"][0]["note_card"]
             return res_dict
-        utils.logger.error(f"[XHSClient.get_note_by_id] get note empty and res:{res}")
+        utils.logger.error("[XHSClient.get_note_by_id] get note empty and res:%s", res)
         return dict()
 
     async def get_note_comments(self, note_id: str, cursor: str = "") -> Dict:
@@ -231,6 +325,75 @@ class XHSClient:
         }
         return await self.get(uri, params)
 
+    async def stream_get_note_comments(self, note_id: str, cursor: str = "",
+                                       callback: Optional[Callable] = None) -> Dict:
+        """
+        流式获取一页一级评论，边下载边用 ijson 解析，每解析出一条评论就交给 callback 处理，
+        适用于评论数据很大的笔记，内存占用只有单条评论大小
+        Args:
+            note_id: 笔记ID
+            cursor: 分页游标
+            callback: 评论处理回调，参数与 get_note_all_comments 的 callback 一致
+
+        Returns: 翻页信息，包含 cursor 和 has_more
+
+        """
+        uri = "/api/sns/web/v2/comment/page"
+        params = {
+            "note_id": note_id,
+            "cursor": cursor
+        }
+        final_uri = f"{uri}?{urlencode(params)}"
+        # 已经交给 callback 的评论数，重试时跳过这些评论，避免重复入库
+        delivered_count = 0
+        async for attempt in self._retrying(True):
+            with attempt:
+                headers = await self._pre_headers(final_uri)
+                async with self._client.stream("GET", f"{self._host}{final_uri}", headers=headers) as response:
+                    if response.is_error:
+                        await response.aread()
+                        try:
+                            data = orjson.loads(response.content)
+                        except orjson.JSONDecodeError:
+                            data = None
+                        if isinstance(data, dict) and data.get("success") is False:
+                            self._raise_data_error(data)
+                        raise DataFetchError(
+                            f"[XHSClient.stream_get_note_comments] unexpected status code: {response.status_code}")
+                    page_info: Dict[str, Any] = {}
+                    comment_index = 0
+                    builder: Optional[ijson.ObjectBuilder] = None
+                    reader = AsyncBytesReader(response.aiter_bytes())
+                    try:
+                        async for prefix, event, value in ijson.parse_async(reader, use_float=True):
+                            if builder is not None:
+                                builder.event(event, value)
+                                if prefix == "data.comments.item" and event == "end_map":
+                                    comment, builder = builder.value, None
+                                    if comment_index >= delivered_count:
+                                        if callback:
+                                            await callback(note_id, [comment])
+                                        delivered_count += 1
+                                    comment_index += 1
+                            elif prefix == "data.comments.item" and event == "start_map":
+                                # 评论之前已经返回了失败标记，不能把数据交给 callback
+                                if page_info.get("success") is False:
+                                    self._raise_data_error(page_info)
+                                builder = ijson.ObjectBuilder()
+                                builder.event(event, value)
+                            elif prefix in ("success", "code", "msg", "data.cursor", "data.has_more"):
+                                page_info[prefix] = value
+                    except ijson.JSONError as e:
+                        raise DataFetchError(
+                            f"[XHSClient.stream_get_note_comments] invalid comments response: {e}") from e
+                if not page_info.get("success"):
+                    self._raise_data_error(page_info)
+                return {
+                    "cursor": page_info.get("data.cursor", ""),
+                    "has_more": page_info.get("data.has_more", False),
+                }
+        raise AssertionError("unreachable")
+
     async def get_note_sub_comments(self, note_id: str, root_comment_id: str, num: int = 30, cursor: str = ""):
         """
         获取指定父评论下的子评论的API
@@ -265,21 +428,94 @@ class XHSClient:
 
         """
         result = []
-        comments_has_more = True
-        comments_cursor = ""
-        while comments_has_more:
-            comments_res = await self.get_note_comments(note_id, comments_cursor)
-            comments_has_more = comments_res.get("has_more", False)
-            comments_cursor = comments_res.get("cursor", "")
-            if "comments" not in comments_res:
-                utils.logger.info(
-                    f"[XHSClient.get_note_all_comments] No 'comments' key found in response: {comments_res}")
-                break
-            comments = comments_res["comments"]
-            if callback:
-                await callback(note_id, comments)
-            await asyncio.sleep(crawl_interval)
-            result.extend(comments)
+        # 翻页时只有 cursor 变化，note_id 部分在整个翻页过程中只编码一次
+        comments_uri = f"/api/sns/web/v2/comment/page?{urlencode({'note_id': note_id})}&cursor="
+        comments_res = await self.get(comments_uri)
+        next_page_task: Optional[asyncio.Task] = None
+        try:
+            while True:
+                comments_has_more = comments_res.get("has_more", False)
+                comments_cursor = comments_res.get("cursor", "")
+                if "comments" not in comments_res:
+                    utils.logger.info(
+                        "[XHSClient.get_note_all_comments] No 'comments' key found in response: %s", comments_res)
+                    break
+                if comments_has_more:
+                    # 下一页只依赖 cursor，提前发起请求，让网络等待与回调的入库处理重叠
+                    next_page_task = asyncio.create_task(
+                        self._get_note_comments_later(comments_uri, comments_cursor, crawl_interval))
+                comments = comments_res["comments"]
+                if callback:
+                    await callback(note_id, comments)
+                result.extend(comments)
+                if not next_page_task:
+                    break
+                comments_res = await next_page_task
+                next_page_task = None
+        finally:
+            if next_page_task:
+                next_page_task.cancel()
+                # 等待取消完成，避免预取任务在异常抛出后仍在运行
+                await asyncio.gather(next_page_task, return_exceptions=True)
+        return result
+
+    async def _get_note_comments_later(self, comments_uri: str, cursor: str, delay: float) -> Dict:
+        """
+        等待 delay 秒后再请求下一页一级评论，保持与原先一致的翻页间隔
+        Args:
+            comments_uri: 已编码好 note_id、以 "cursor=" 结尾的一级评论请求路由
+            cursor: 分页游标
+            delay: 延迟时间（秒）
+
+        Returns:
+
+        """
+        await asyncio.sleep(delay)
+        return await self.get(f"{comments_uri}{quote_plus(cursor)}")
+
+    async def get_comments_all_sub_comments(self, note_id: str, comments: List[Dict], crawl_interval: float = 1.0,
+                                            max_concurrency: int = 4) -> List[Dict]:
+        """
+        获取一批一级评论下的所有子评论，包括一级评论中已经内嵌返回的第一页子评论（sub_comments），
+        以及从 sub_comment_cursor 开始按 cursor 一直翻页到 has_more 为 False 的后续子评论，
+        不同一级评论之间并发获取，使用信号量限制并发数
+        Args:
+            note_id: 笔记ID
+            comments: 一级评论列表
+            crawl_interval: 每次翻页请求之间的延迟（秒）
+            max_concurrency: 最大并发请求数
+
+        Returns:
+
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _get_all_sub_comments(comment: Dict) -> List[Dict]:
+            sub_comments = list(comment.get("sub_comments", []))
+            sub_comments_has_more = comment.get("sub_comment_has_more", False)
+            sub_comments_cursor = comment.get("sub_comment_cursor", "")
+            if not sub_comments_has_more:
+                return sub_comments
+            async with semaphore:
+                while sub_comments_has_more:
+                    sub_comments_res = await self.get_note_sub_comments(
+                        note_id, comment["id"], cursor=sub_comments_cursor)
+                    sub_comments_has_more = sub_comments_res.get("has_more", False)
+                    sub_comments_cursor = sub_comments_res.get("cursor", "")
+                    if "comments" not in sub_comments_res:
+                        utils.logger.info(
+                            "[XHSClient.get_comments_all_sub_comments] No 'comments' key found in response: %s",
+                            sub_comments_res)
+                        break
+                    sub_comments.extend(sub_comments_res["comments"])
+                    if sub_comments_has_more:
+                        await asyncio.sleep(crawl_interval)
+            return sub_comments
+
+        sub_comments_list = await asyncio.gather(*[_get_all_sub_comments(comment) for comment in comments])
+        result = []
+        for sub_comments in sub_comments_list:
+            result.extend(sub_comments)
         return result
 
     async def get_upload_files_permit(self, file_type: str, count: int = 1) -> tuple:
@@ -321,14 +557,17 @@ class XHSClient:
         # 5M 为一个 part
         max_file_size = 5 * 1024 * 1024
         url = "https://ros-upload.xiaohongshu.com/" + file_id
-        if os.path.getsize(file_path) > max_file_size and content_type == "video/mp4":
+        file_size = (await aiofiles.os.stat(file_path)).st_size
+        if file_size > max_file_size and content_type == "video/mp4":
             raise Exception("video too large, < 5M")
             # return self.upload_file_with_slice(file_id, token, file_path)
         else:
-            headers = {"X-Cos-Security-Token": token, "Content-Type": content_type}
-            # with open(file_path, "rb") as f:
-            async with aiofiles.open(file_path, "rb") as f:
-                return await self.request("PUT", url, data=f, headers=headers)
+            headers = {
+                "X-Cos-Security-Token": token,
+                "Content-Type": content_type,
+                "Content-Length": str(file_size),
+            }
+            return await self.request("PUT", url, content=read_file_chunks(file_path), headers=headers)
 
     async def create_note(self, title, desc, note_type, ats: list = None, topics: list = None,
                           image_info: dict = None,
@@ -337,7 +576,7 @@ class XHSClient:
         """创建日志"""
 
         if post_time:
-            post_date_time = datetime.strptime(post_time, "%Y-%m-%d %H:%M:%S")
+            post_date_time = datetime.fromisoformat(post_time)
             post_time = round(int(post_date_time.timestamp()) * 1000)
         uri = "/web_api/sns/v2/note"
         business_binds = {
@@ -359,7 +598,7 @@ class XHSClient:
                 "note_id": "",
                 "desc": desc,
                 "source": '{"type":"web","ids":"","extraInfo":"{\\"subType\\":\\"official\\"}"}',
-                "business_binds": json.dumps(business_binds, separators=(",", ":")),
+                "business_binds": orjson.dumps(business_binds).decode(),
                 "ats": ats,
                 "hash_tag": topics,
                 "post_loc": {},
@@ -371,7 +610,6 @@ class XHSClient:
         # headers = {
         #     "Referer": "https://creator.xiaohongshu.com/"
         # }
-        print(data)
         return await self.post(uri, data)
 
     async def create_image_note(self, title, desc, files: list,
@@ -396,18 +634,31 @@ class XHSClient:
         if topics is None:
             topics = []
 
-        images = []
-        for file in files:
-            image_id, token = await self.get_upload_files_permit("image")
-            await self.upload_file(image_id, token, file)
-            images.append(
-                {
-                    "file_id": image_id,
-                    "metadata": {"source": -1},
-                    "stickers": {"version": 2, "floating": []},
-                    "extra_info_json": '{"mimeType":"image/jpeg"}',
-                }
-            )
+        # 限制同时进行的申请上传+上传链路数量，避免瞬时并发过高被 CDN 限流
+        semaphore = asyncio.Semaphore(6)
+
+        async def _upload_image(file: str) -> Dict:
+            async with semaphore:
+                image_id, token = await self.get_upload_files_permit("image")
+                await self.upload_file(image_id, token, file)
+            return {
+                "file_id": image_id,
+                "metadata": {"source": -1},
+                "stickers": {"version": 2, "floating": []},
+                "extra_info_json": '{"mimeType":"image/jpeg"}',
+            }
+
+        # 每张图片的申请上传+上传互不依赖，并发执行，gather 保证结果顺序与 files 一致
+        upload_tasks = [asyncio.create_task(_upload_image(file)) for file in files]
+        try:
+            images = await asyncio.gather(*upload_tasks)
+        except Exception:
+            # 任意一张上传失败，笔记不会再发布，取消其余还在进行的上传
+            for task in upload_tasks:
+                task.cancel()
+            # 等待取消完成并取回其余任务的异常，避免出现 "Task exception was never retrieved"
+            await asyncio.gather(*upload_tasks, return_exceptions=True)
+            raise
         return await self.create_note(title, desc, NoteType.NORMAL.value, ats=ats, topics=topics,
-                                      image_info={"images": images}, is_private=is_private,
+                                      image_info={"images": list(images)}, is_private=is_private,
                                       post_time=post_time)
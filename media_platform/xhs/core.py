@@ -15,6 +15,7 @@ from var import crawler_type_var
 from enum import Enum
 from .client import XHSClient
 from .exception import DataFetchError
+from .help import get_search_id
 from .login import XHSLogin
 
 
@@ -65,31 +66,34 @@ class XiaoHongShuCrawler(AbstractCrawler):
 
             # Create a client to interact with the xiaohongshu website.
             self.xhs_client = await self.create_xhs_client(httpx_proxy_format)
-            if not await self.xhs_client.pong():
-                login_obj = XHSLogin(
-                    login_type=self.login_type,
-                    login_phone="",  # input your phone number
-                    browser_context=self.browser_context,
-                    context_page=self.context_page,
-                    cookie_str=config.COOKIES
-                )
-                await login_obj.begin()
-                await self.xhs_client.update_cookies(browser_context=self.browser_context)
-
-            # 不搜索注释掉
-            # crawler_type_var.set(self.crawler_type)
-            # if self.crawler_type == "search":
-            #     # Search for notes and retrieve their comment information.
-            #     await self.search()
-            # elif self.crawler_type == "detail":
-            #     # Get the information and comments of the specified post
-            #     await self.get_specified_notes()
-            # else:
-            #     pass
-
-            me_info = await self.xhs_client.get_self_info()
-            print(me_info)
-            await self.create_img_note()
+            try:
+                if not await self.xhs_client.pong():
+                    login_obj = XHSLogin(
+                        login_type=self.login_type,
+                        login_phone="",  # input your phone number
+                        browser_context=self.browser_context,
+                        context_page=self.context_page,
+                        cookie_str=config.COOKIES
+                    )
+                    await login_obj.begin()
+                    await self.xhs_client.update_cookies(browser_context=self.browser_context)
+
+                # 不搜索注释掉
+                # crawler_type_var.set(self.crawler_type)
+                # if self.crawler_type == "search":
+                #     # Search for notes and retrieve their comment information.
+                #     await self.search()
+                # elif self.crawler_type == "detail":
+                #     # Get the information and comments of the specified post
+                #     await self.get_specified_notes()
+                # else:
+                #     pass
+
+                me_info = await self.xhs_client.get_self_info()
+                print(me_info)
+                await self.create_img_note()
+            finally:
+                await self.xhs_client.aclose()
             utils.logger.info("[XiaoHongShuCrawler.start] Xhs Crawler finished ...")
 
     async def create_img_note(self) -> None:
@@ -106,15 +110,18 @@ class XiaoHongShuCrawler(AbstractCrawler):
         utils.logger.info("[XiaoHongShuCrawler.search] Begin search xiaohongshu keywords")
         xhs_limit_count = 20  # xhs limit page fixed value
         for keyword in config.KEYWORDS.split(","):
-            utils.logger.info(f"[XiaoHongShuCrawler.search] Current search keyword: {keyword}")
+            utils.logger.info("[XiaoHongShuCrawler.search] Current search keyword: %s", keyword)
             page = 1
+            # 同一个关键词的所有分页共用一个 search_id
+            search_id = get_search_id()
             while page * xhs_limit_count <= config.CRAWLER_MAX_NOTES_COUNT:
                 note_id_list: List[str] = []
                 notes_res = await self.xhs_client.get_note_by_keyword(
                     keyword=keyword,
                     page=page,
+                    search_id=search_id,
                 )
-                utils.logger.info(f"[XiaoHongShuCrawler.search] Search notes res:{notes_res}")
+                utils.logger.info("[XiaoHongShuCrawler.search] Search notes res:%s", notes_res)
                 semaphore = asyncio.Semaphore(config.MAX_CONCURRENCY_NUM)
                 task_list = [
                     self.get_note_detail(post_item.get("id"), semaphore)
@@ -127,7 +134,7 @@ class XiaoHongShuCrawler(AbstractCrawler):
                         await xhs_store.update_xhs_note(note_detail)
                         note_id_list.append(note_detail.get("note_id"))
                 page += 1
-                utils.logger.info(f"[XiaoHongShuCrawler.search] Note details: {note_details}")
+                utils.logger.info("[XiaoHongShuCrawler.search] Note details: %s", note_details)
                 await self.batch_get_note_comments(note_id_list)
 
     async def get_specified_notes(self):
@@ -148,17 +155,17 @@ class XiaoHongShuCrawler(AbstractCrawler):
             try:
                 return await self.xhs_client.get_note_by_id(note_id)
             except DataFetchError as ex:
-                utils.logger.error(f"[XiaoHongShuCrawler.get_note_detail] Get note detail error: {ex}")
+                utils.logger.error("[XiaoHongShuCrawler.get_note_detail] Get note detail error: %s", ex)
                 return None
             except KeyError as ex:
                 utils.logger.error(
-                    f"[XiaoHongShuCrawler.get_note_detail] have not fund note detail note_id:{note_id}, err: {ex}")
+                    "[XiaoHongShuCrawler.get_note_detail] have not fund note detail note_id:%s, err: %s", note_id, ex)
                 return None
 
     async def batch_get_note_comments(self, note_list: List[str]):
         """Batch get note comments"""
         utils.logger.info(
-            f"[XiaoHongShuCrawler.batch_get_note_comments] Begin batch get note comments, note list: {note_list}")
+            "[XiaoHongShuCrawler.batch_get_note_comments] Begin batch get note comments, note list: %s", note_list)
         semaphore = asyncio.Semaphore(config.MAX_CONCURRENCY_NUM)
         task_list: List[Task] = []
         for note_id in note_list:
@@ -169,7 +176,7 @@ class XiaoHongShuCrawler(AbstractCrawler):
     async def get_comments(self, note_id: str, semaphore: asyncio.Semaphore):
         """Get note comments with keyword filtering and quantity limitation"""
         async with semaphore:
-            utils.logger.info(f"[XiaoHongShuCrawler.get_comments] Begin get note id comments {note_id}")
+            utils.logger.info("[XiaoHongShuCrawler.get_comments] Begin get note id comments %s", note_id)
             await self.xhs_client.get_note_all_comments(
                 note_id=note_id,
                 crawl_interval=random.random(),
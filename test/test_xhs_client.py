@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from typing import AsyncIterator, Callable, Dict, List
+from unittest import IsolatedAsyncioTestCase, mock
+from urllib.parse import urlencode
+
+import httpx
+import orjson
+from tenacity import AsyncRetrying, wait_none
+
+from media_platform.xhs.client import XHSClient
+from media_platform.xhs.exception import DataFetchError, IPBlockError
+
+
+class FakePage:
+    """模拟 playwright 页面，返回签名参数和 b1，每次签名的 X-t 递增"""
+
+    def __init__(self):
+        self.sign_count = 0
+
+    async def evaluate(self, expression: str, arg=None):
+        self.sign_count += 1
+        encrypt_params = {"X-s": "X" * 64, "X-t": 1700000000000 + self.sign_count}
+        sign_requested = "_webmsxyw" in expression
+        b1_requested = "localStorage" in expression
+        if sign_requested and b1_requested:
+            return [encrypt_params, "b1"]
+        if sign_requested:
+            return encrypt_params
+        if b1_requested:
+            return "b1"
+        raise ValueError(f"unexpected expression: {expression}")
+
+
+async def iter_chunks(body: bytes, chunk_size: int = 7) -> AsyncIterator[bytes]:
+    for i in range(0, len(body), chunk_size):
+        yield body[i:i + chunk_size]
+
+
+class MockTransportTestCase(IsolatedAsyncioTestCase):
+    """使用 httpx.MockTransport 替换 XHSClient 真实连接池的测试基类"""
+
+    async def asyncSetUp(self):
+        self.clients: List[XHSClient] = []
+
+    async def asyncTearDown(self):
+        for client in self.clients:
+            await client.aclose()
+
+    async def create_mock_client(self, handler: Callable[[httpx.Request], httpx.Response]) -> XHSClient:
+        client = XHSClient(headers={}, playwright_page=FakePage(), cookie_dict={})
+        # 先关闭 __init__ 中创建的真实连接池，再换成 MockTransport，aclose 时会关闭 mock 客户端
+        await client.aclose()
+        client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        self.clients.append(client)
+        return client
+
+
+class TestXHSClientStreamComments(MockTransportTestCase):
+    async def create_client(self, status_code: int, body: bytes) -> XHSClient:
+        def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(status_code, content=iter_chunks(body))
+
+        return await self.create_mock_client(handler)
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.received: List[Dict] = []
+
+    async def callback(self, note_id: str, comments: List[Dict]):
+        self.assertEqual(note_id, "note1")
+        self.received.extend(comments)
+
+    async def test_stream_comments(self):
+        body = orjson.dumps({
+            "code": 0,
+            "success": True,
+            "msg": "成功",
+            "data": {
+                "comments": [
+                    {"id": "c1", "content": "第一条", "user_info": {"user_id": "u1"}, "like_count": "1"},
+                    {"id": "c2", "content": "第二条", "sub_comments": [{"id": "s1"}]},
+                ],
+                "cursor": "c2",
+                "has_more": True,
+            },
+        })
+        client = await self.create_client(200, body)
+        page_info = await client.stream_get_note_comments("note1", callback=self.callback)
+        self.assertEqual(page_info, {"cursor": "c2", "has_more": True})
+        self.assertEqual([comment["id"] for comment in self.received], ["c1", "c2"])
+        self.assertEqual(self.received[0]["user_info"], {"user_id": "u1"})
+        self.assertEqual(self.received[1]["sub_comments"], [{"id": "s1"}])
+
+    async def test_failed_response_skips_callback(self):
+        body = orjson.dumps({
+            "success": False,
+            "code": -1,
+            "msg": "签名错误",
+            "data": {"comments": [{"id": "c1"}]},
+        })
+        client = await self.create_client(200, body)
+        with self.assertRaises(DataFetchError):
+            await client.stream_get_note_comments("note1", callback=self.callback)
+        self.assertEqual(self.received, [])
+
+    async def test_invalid_json(self):
+        client = await self.create_client(200, b"<html>blocked</html>")
+        with self.assertRaises(DataFetchError):
+            await client.stream_get_note_comments("note1", callback=self.callback)
+
+    async def test_error_status(self):
+        client = await self.create_client(502, b"Bad Gateway")
+        with self.assertRaises(DataFetchError):
+            await client.stream_get_note_comments("note1", callback=self.callback)
+        self.assertEqual(self.received, [])
+
+
+class TestXHSClientRetry(MockTransportTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.requests: List[httpx.Request] = []
+        retrying = XHSClient._retrying
+
+        def retrying_without_wait(retry_on_error: bool) -> AsyncRetrying:
+            retrying_obj = retrying(retry_on_error)
+            retrying_obj.wait = wait_none()
+            return retrying_obj
+
+        patcher = mock.patch.object(XHSClient, "_retrying", staticmethod(retrying_without_wait))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def create_client(self, bodies: List[Dict]) -> XHSClient:
+        """按顺序返回 bodies 中的响应，最后一个响应会一直重复"""
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            self.requests.append(request)
+            body = bodies[min(len(self.requests), len(bodies)) - 1]
+            return httpx.Response(200, content=orjson.dumps(body))
+
+        return await self.create_mock_client(handler)
+
+    async def test_get_retry_ip_block_with_new_sign(self):
+        client = await self.create_client([
+            {"success": False, "code": 300012, "msg": "ip block"},
+            {"success": True, "code": 0, "data": {"items": []}},
+        ])
+        res = await client.get("/api/sns/web/v1/user/selfinfo")
+        self.assertEqual(res, {"items": []})
+        self.assertEqual(len(self.requests), 2)
+        self.assertNotEqual(self.requests[0].headers["X-T"], self.requests[1].headers["X-T"])
+        self.assertNotEqual(self.requests[0].headers["X-B3-Traceid"], self.requests[1].headers["X-B3-Traceid"])
+
+    async def test_post_not_retried_by_default(self):
+        client = await self.create_client([{"success": False, "code": 300012, "msg": "ip block"}])
+        with self.assertRaises(IPBlockError):
+            await client.post("/api/sns/web/v1/feed", {"source_note_id": "note1"})
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_post_retried_when_enabled(self):
+        client = await self.create_client([
+            {"success": False, "code": 300012, "msg": "ip block"},
+            {"success": True, "code": 0, "data": {"items": []}},
+        ])
+        res = await client.post("/api/sns/web/v1/feed", {"source_note_id": "note1"}, retry_on_error=True)
+        self.assertEqual(res, {"items": []})
+        self.assertEqual(len(self.requests), 2)
+        self.assertNotEqual(self.requests[0].headers["X-T"], self.requests[1].headers["X-T"])
+
+
+class TestXHSClientPaginateComments(MockTransportTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.requests: List[httpx.Request] = []
+
+    async def create_client(self, pages: Dict[str, Dict]) -> XHSClient:
+        """pages 以 cursor 为 key，返回对应页的数据"""
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            self.requests.append(request)
+            page = pages[request.url.params.get("cursor", "")]
+            return httpx.Response(200, content=orjson.dumps({"success": True, "code": 0, "data": page}))
+
+        return await self.create_mock_client(handler)
+
+    async def test_get_note_all_comments_pages(self):
+        client = await self.create_client({
+            "": {"comments": [{"id": "c1"}, {"id": "c2"}], "cursor": "p2", "has_more": True},
+            "p2": {"comments": [{"id": "c3"}], "cursor": "p3", "has_more": True},
+            "p3": {"comments": [{"id": "c4"}], "cursor": "", "has_more": False},
+        })
+        received: List[str] = []
+
+        async def callback(note_id: str, comments: List[Dict]):
+            received.extend(comment["id"] for comment in comments)
+
+        result = await client.get_note_all_comments("note1", crawl_interval=0, callback=callback)
+        self.assertEqual([comment["id"] for comment in result], ["c1", "c2", "c3", "c4"])
+        self.assertEqual(received, ["c1", "c2", "c3", "c4"])
+        self.assertEqual([request.url.params["cursor"] for request in self.requests], ["", "p2", "p3"])
+
+    async def test_get_note_all_comments_query_matches_urlencode(self):
+        cursor = '{"cursor":"6a b/c+","index":2}'
+        client = await self.create_client({
+            "": {"comments": [{"id": "c1"}], "cursor": cursor, "has_more": True},
+            cursor: {"comments": [{"id": "c2"}], "cursor": "", "has_more": False},
+        })
+        await client.get_note_all_comments("note 1", crawl_interval=0)
+        self.assertEqual(self.requests[1].url.query.decode(), urlencode({"note_id": "note 1", "cursor": cursor}))
+
+    async def test_get_note_all_comments_cancel_prefetch_on_callback_error(self):
+        client = await self.create_client({
+            "": {"comments": [{"id": "c1"}], "cursor": "p2", "has_more": True},
+            "p2": {"comments": [{"id": "c2"}], "cursor": "", "has_more": False},
+        })
+
+        async def callback(note_id: str, comments: List[Dict]):
+            raise RuntimeError("store failed")
+
+        with self.assertRaises(RuntimeError):
+            await client.get_note_all_comments("note1", crawl_interval=0.05, callback=callback)
+        pending_tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        self.assertEqual(pending_tasks, [])
+        await asyncio.sleep(0.1)
+        # 下一页的预取任务已被取消，不会再发出请求
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_get_comments_all_sub_comments(self):
+        def handler(request: httpx.Request) -> httpx.Response:
+            self.requests.append(request)
+            pages = {
+                "s1": {"comments": [{"id": "r1-s2"}], "cursor": "s2", "has_more": True},
+                "s2": {"comments": [{"id": "r1-s3"}], "cursor": "", "has_more": False},
+            }
+            page = pages[request.url.params["cursor"]]
+            return httpx.Response(200, content=orjson.dumps({"success": True, "code": 0, "data": page}))
+
+        client = await self.create_mock_client(handler)
+        comments = [
+            {"id": "r1", "sub_comments": [{"id": "r1-s1"}], "sub_comment_has_more": True,
+             "sub_comment_cursor": "s1"},
+            {"id": "r2", "sub_comments": [{"id": "r2-s1"}], "sub_comment_has_more": False},
+        ]
+        with mock.patch("asyncio.sleep", new=mock.AsyncMock()) as sleep_mock:
+            result = await client.get_comments_all_sub_comments("note1", comments, crawl_interval=1)
+        self.assertEqual([comment["id"] for comment in result], ["r1-s1", "r1-s2", "r1-s3", "r2-s1"])
+        self.assertEqual([request.url.params["root_comment_id"] for request in self.requests], ["r1", "r1"])
+        # 只在还有下一页时等待，最后一页之后不再等待
+        self.assertEqual(sleep_mock.await_count, 1)
+
+
+class TestXHSClientCreateImageNote(MockTransportTestCase):
+    async def test_failed_upload_cancels_other_uploads(self):
+        def handler(request: httpx.Request) -> httpx.Response:
+            raise AssertionError(f"unexpected request: {request.url}")
+
+        client = await self.create_mock_client(handler)
+        started = 0
+        cancelled = 0
+
+        async def get_upload_files_permit(file_type: str, count: int = 1) -> tuple:
+            nonlocal started, cancelled
+            started += 1
+            if started == 2:
+                raise DataFetchError("permit failed")
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled += 1
+                raise
+            return "file_id", "token"
+
+        with mock.patch.object(client, "get_upload_files_permit", new=get_upload_files_permit), \
+                mock.patch.object(client, "upload_file", new=mock.AsyncMock()) as upload_file_mock, \
+                mock.patch.object(client, "create_note", new=mock.AsyncMock()) as create_note_mock:
+            with self.assertRaises(DataFetchError):
+                await client.create_image_note("title", "desc", ["1.jpg", "2.jpg", "3.jpg", "4.jpg"])
+
+        self.assertEqual(started, 4)
+        self.assertEqual(cancelled, 3)
+        upload_file_mock.assert_not_awaited()
+        create_note_mock.assert_not_awaited()
+        pending_tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        self.assertEqual(pending_tasks, [])